@@ -1,100 +1,592 @@
+import numpy as np
 import pandas as pd
-from functools import reduce
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv
+import pyarrow.feather
+import pyarrow.parquet
+from functools import lru_cache, partial, reduce
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
+import copy
+import csv
+import hashlib
+import multiprocessing
 import os
+import re
+import tempfile
 import argparse
 
-def write_table(df:pd.DataFrame, filepath:str, **kwargs):
+#public API, re-exported by the package __init__
+__all__=[
+    'write_table','table_from_pandas','read_csv','pandas_csv_kwargs','read_excel','READERS','extract_files','read_file','cached_read',
+    'load_file','iter_files','load_files','stack_tables','first_per_patient','group_first',
+    'merge_patient_dataframes','fold_batch','fold_tables',
+    'patient_partitions','spill_partitions','merge_partition','merge_files_partitioned','merge_files',
+    'normalize_str_series','normalize_arrow_str_series','compare_columns',
+    'sanity_check_dataframes','parse_conflicts','main',
+    ]
+
+def write_table(table:pa.Table|pd.DataFrame, filepath:str, index:bool=False, **kwargs):
+    '''
+    Write a table, the format depends on the file extension.
+    csv and parquet are written by Arrow, xlsx by pandas.
+    index: whether to write the index of a DataFrame (default: False)
+    kwargs are passed to the writer: pyarrow.csv.write_csv (e.g. write_options) for csv,
+    pyarrow.parquet.write_table for parquet and DataFrame.to_excel for xlsx.
+    pandas to_csv options are only used for DataFrames that Arrow cannot convert (mixed-type object columns).
+    '''
     extension=Path(filepath).suffix.lower()
-    writers={
-        ".csv": df.to_csv,
-        ".xlsx": df.to_excel
-        }
-    if extension in writers:
-        writers[extension](filepath, **kwargs)
-
-def get_readers(**kwargs):
-    return{
-            '.csv':lambda x:pd.read_csv(x,**kwargs),
-            '.tsv':lambda x:pd.read_tsv(x,**kwargs),
-            '.xlsx':lambda x:pd.read_excel(x,**kwargs),
-            '.xls':lambda x:pd.read_excel(x,**kwargs),
+    if extension==".xlsx":
+        df=table.to_pandas(types_mapper=pd.ArrowDtype) if isinstance(table,pa.Table) else table
+        df.to_excel(filepath,index=index,**kwargs)
+        return
+    if isinstance(table,pd.DataFrame):
+        try:
+            table=pa.Table.from_pandas(table.reset_index() if index else table,preserve_index=False)
+        except (pa.ArrowInvalid,pa.ArrowTypeError):
+            if extension!=".csv":
+                raise
+            table.to_csv(filepath,index=index,**kwargs)
+            return
+    if extension==".csv":
+        kwargs.setdefault('write_options',pyarrow.csv.WriteOptions(include_header=True))
+        pyarrow.csv.write_csv(table,filepath,**kwargs)
+    elif extension==".parquet":
+        kwargs.setdefault('compression','zstd')
+        pyarrow.parquet.write_table(table,filepath,**kwargs)
+
+def table_from_pandas(df:pd.DataFrame)->pa.Table:
+    '''
+    Convert a DataFrame to an Arrow table, without its index.
+    Object columns that Arrow cannot convert (mixed types, e.g. IDs 1 and 'P2') are cast to string, missing values are kept.
+    '''
+    try:
+        return pa.Table.from_pandas(df,preserve_index=False)
+    except (pa.ArrowInvalid,pa.ArrowTypeError):
+        pass
+    columns={}
+    for i,name in enumerate(df.columns):
+        column=df.iloc[:,i]
+        if column.dtype==object:
+            try:
+                pa.array(column,from_pandas=True)
+            except (pa.ArrowInvalid,pa.ArrowTypeError):
+                column=column.map(str,na_action='ignore')
+        columns[name]=column
+    return pa.Table.from_pandas(pd.DataFrame(columns),preserve_index=False)
+
+#keyword arguments of pyarrow.csv.read_csv, the only reader kwargs accepted for csv and tsv files
+CSV_READER_KWARGS=frozenset({'read_options','parse_options','convert_options','memory_pool'})
+
+def read_csv(filepath:str, delimiter:str=',', **kwargs)->pa.Table:
+    '''
+    Parse a delimited file with the multithreaded Arrow reader.
+    kwargs are pyarrow.csv.read_csv options (read_options, parse_options, convert_options, memory_pool),
+    pandas read_csv options (sep, encoding, dtype...) raise a TypeError.
+    A caller's read_options keep their settings (8 MiB blocks unless block_size was changed),
+    the delimiter of a caller's parse_options is set from the file extension,
+    and a caller's convert_options replace the default one (empty cells are missing values).
+    Files Arrow cannot parse (e.g. short rows) are read by pandas, see pandas_csv_kwargs for the options it applies.
+    '''
+    unknown=set(kwargs)-CSV_READER_KWARGS
+    if unknown:
+        raise TypeError('read_csv got {}: csv and tsv files take pyarrow.csv.read_csv options ({})'.format(
+            ', '.join(sorted(unknown)),', '.join(sorted(CSV_READER_KWARGS))))
+    read_options=copy.copy(kwargs.pop('read_options',None) or pyarrow.csv.ReadOptions())
+    if read_options.block_size==pyarrow.csv.ReadOptions().block_size:
+        read_options.block_size=8<<20
+    #rebuilt rather than copied, a copy loses the invalid_row_handler
+    caller_parse_options=kwargs.pop('parse_options',None) or pyarrow.csv.ParseOptions()
+    parse_options=pyarrow.csv.ParseOptions(
+        delimiter=delimiter,
+        quote_char=caller_parse_options.quote_char,
+        double_quote=caller_parse_options.double_quote,
+        escape_char=caller_parse_options.escape_char,
+        newlines_in_values=caller_parse_options.newlines_in_values,
+        ignore_empty_lines=caller_parse_options.ignore_empty_lines,
+        invalid_row_handler=caller_parse_options.invalid_row_handler,
+        )
+    #empty cells are missing values, as with pd.read_csv
+    convert_options=kwargs.pop('convert_options',None) or pyarrow.csv.ConvertOptions(strings_can_be_null=True)
+    try:
+        return pyarrow.csv.read_csv(
+            filepath,
+            read_options=read_options,
+            parse_options=parse_options,
+            convert_options=convert_options,
+            **kwargs
+            )
+    except pa.ArrowInvalid:
+        #e.g. short rows, which pandas pads with nan
+        pandas_kwargs=pandas_csv_kwargs(read_options,parse_options,convert_options)
+        df=pd.read_csv(filepath,**pandas_kwargs)
+        if read_options.autogenerate_column_names and not read_options.column_names:
+            df.columns=[f'f{i}' for i in range(len(df.columns))]
+        return table_from_pandas(df)
+
+def pandas_csv_kwargs(read_options:pyarrow.csv.ReadOptions, parse_options:pyarrow.csv.ParseOptions, convert_options:pyarrow.csv.ConvertOptions)->dict:
+    '''
+    pd.read_csv equivalents of the Arrow csv options, for the pandas fallback of read_csv.
+    Applied: delimiter, quoting, encoding, skip_rows, column names, include_columns, column_types,
+    null/true/false values and decimal point. Other options (e.g. timestamp_parsers, auto_dict_encode) are not.
+    '''
+    default=pyarrow.csv.ConvertOptions()
+    kwargs={
+        'sep':parse_options.delimiter,
+        'doublequote':parse_options.double_quote,
+        'encoding':read_options.encoding,
+        'skiprows':read_options.skip_rows,
+        'decimal':convert_options.decimal_point,
         }
+    if parse_options.quote_char:
+        kwargs['quotechar']=parse_options.quote_char
+    else:
+        kwargs['quoting']=csv.QUOTE_NONE
+    if parse_options.escape_char:
+        kwargs['escapechar']=parse_options.escape_char
+    if read_options.column_names:
+        kwargs['names']=read_options.column_names
+        kwargs['header']=None
+    elif read_options.autogenerate_column_names:
+        kwargs['header']=None
+    if convert_options.include_columns:
+        kwargs['usecols']=convert_options.include_columns
+    if convert_options.column_types:
+        kwargs['dtype']={name:pd.ArrowDtype(t) for name,t in convert_options.column_types.items()}
+    if convert_options.null_values!=default.null_values:
+        kwargs['na_values']=convert_options.null_values
+        kwargs['keep_default_na']=False
+    if convert_options.true_values!=default.true_values:
+        kwargs['true_values']=convert_options.true_values
+    if convert_options.false_values!=default.false_values:
+        kwargs['false_values']=convert_options.false_values
+    return kwargs
+
+def read_excel(filepath:str, **kwargs)->pa.Table:
+    return table_from_pandas(pd.read_excel(filepath,**kwargs))
+
+#extension -> reader(filepath, **kwargs), built once
+READERS={
+        '.csv':partial(read_csv,delimiter=','),
+        '.tsv':partial(read_csv,delimiter='\t'),
+        '.xlsx':read_excel,
+        '.xls':read_excel,
+    }
         
 
 
 def extract_files(input_directory)->list[str]:
-    dir_path=Path(input_directory)
     if not os.path.isdir(input_directory):
         raise ValueError('{} is not a valid directory'.format(input_directory))
-    allowed_exts=set(get_readers().keys())
-
-    files=[str(p)for p in dir_path.rglob("*")if p.suffix.lower() in allowed_exts]
+    allowed_exts=frozenset(READERS)
+
+    #os.walk + plain strings, no Path object per directory entry
+    files=[]
+    for root,_,names in os.walk(input_directory):
+        for name in names:
+            if os.path.splitext(name)[1].lower() in allowed_exts:
+                files.append(os.path.join(root,name))
     return files
     
-def read_file(file:str,**kwargs):
-    readers=get_readers(**kwargs)
-    extension=Path(file).suffix.lower()
+def read_file(file:str,**kwargs)->pa.Table|None:
+    reader=READERS.get(os.path.splitext(file)[1].lower())
 
-    if extension in readers.keys():
-        return readers[extension](file)
+    if reader is not None:
+        return reader(file,**kwargs)
 
     #if reader not available
     return None
 
-def load_files(file_paths:list[str],add_filenamecolumn:bool,filename_column='TABLENAME',**reader_kwargs)->list[pd.DataFrame]:
+def cached_read(file:str,cache_dir:str,**kwargs)->pa.Table|None:
+    '''
+    Same as read_file, with a feather copy of the parsed table kept in cache_dir.
+    The cache key depends on the path, mtime and size of the file, so edited files are parsed again.
+    '''
+    stat=os.stat(file)
+    key=hashlib.blake2b(
+        f"{os.path.abspath(file)}:{stat.st_mtime}:{stat.st_size}:{sorted(kwargs.items())}".encode()
+        ).hexdigest()[:16]
+    cache_path=Path(cache_dir)/f"{key}.feather"
+    if cache_path.is_file():
+        return pyarrow.feather.read_table(cache_path)
+
+    table=read_file(file,**kwargs)
+    if table is not None:
+        cache_path.parent.mkdir(parents=True,exist_ok=True)
+        #write to a temporary file then rename, so that a crash or a concurrent run never leaves a truncated cache entry
+        fd,tmp_path=tempfile.mkstemp(dir=cache_path.parent,suffix='.tmp')
+        os.close(fd)
+        try:
+            pyarrow.feather.write_feather(table,tmp_path,compression='zstd')
+            os.replace(tmp_path,cache_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    return table
+
+def load_file(path:str,add_filenamecolumn:bool,filename_column='TABLENAME',cache_dir=None,**reader_kwargs)->pa.Table|None:
+    """
+    Load a single file into an Arrow table
+    If cache_dir is given, the parsed file is cached there (see cached_read)
+    Returns None if the file cannot be read
+    """
+    try: 
+        if cache_dir:
+            table=cached_read(path,cache_dir,**reader_kwargs)
+        else:
+            table=read_file(path,**reader_kwargs)
+    except ValueError:
+        print('Error Reading {}'.format(path))
+        return None
+    if table is None:
+        print('No reader for {}'.format(path))
+        return None
+    if add_filenamecolumn:
+        #dictionary-encoded: a single string and one index per row
+        filename=pa.DictionaryArray.from_arrays(pa.array(np.zeros(table.num_rows,np.int32)),pa.array([os.path.basename(path)]))
+        if filename_column in table.column_names:
+            #replaced, as df[filename_column]=... did: a duplicate column name cannot be stacked
+            table=table.set_column(table.schema.get_field_index(filename_column),filename_column,filename)
+        else:
+            table=table.append_column(filename_column,filename)
+    return table
+
+def iter_files(file_paths:list[str],add_filenamecolumn:bool,filename_column='TABLENAME',cache_dir=None,max_workers=None,**reader_kwargs):
     """
-    Load a list of csv files into pd Dataframe
+    Load files into Arrow tables in a thread pool, yielded in the order of file_paths
+    Parsing releases the GIL, so reads overlap. At most max_workers files are read ahead.
+    Files that cannot be read are skipped.
     """
-    dfs = []
-    for path in file_paths:
-        try: 
-            df=read_file(path,**reader_kwargs)
-        except ValueError:
-            print('Error Reading {}'.format(path))
-        if add_filenamecolumn:
-            df[filename_column]=Path(path).name
-        dfs.append(df)
-    return dfs
+    if max_workers is None:
+        max_workers=min(32,os.cpu_count() or 1)
+    load=partial(load_file,add_filenamecolumn=add_filenamecolumn,filename_column=filename_column,cache_dir=cache_dir,**reader_kwargs)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending=deque()
+        for path in file_paths:
+            pending.append(executor.submit(load,path))
+            if len(pending)>=max_workers:
+                table=pending.popleft().result()
+                if table is not None:
+                    yield table
+        while pending:
+            table=pending.popleft().result()
+            if table is not None:
+                yield table
+
+def load_files(file_paths:list[str],add_filenamecolumn:bool,filename_column='TABLENAME',cache_dir=None,max_workers=None,**reader_kwargs)->list[pa.Table]:
+    """
+    Load a list of csv files into Arrow tables
+    reader_kwargs are passed to the reader of every file: pyarrow.csv.read_csv options for csv and tsv
+    (read_options, parse_options, convert_options, see read_csv), pd.read_excel options for xlsx and xls
+    """
+    return list(iter_files(file_paths,add_filenamecolumn,filename_column,cache_dir,max_workers,**reader_kwargs))
 
 
-def merge_patient_dataframes(dfs, patient_col="Patient")->pd.DataFrame:
+def stack_tables(tables:list[pa.Table])->pa.Table:
+    """
+    Vertical stacking, columns missing from a table are filled with nulls.
+    The chunks of each table are referenced, not copied into a new block.
+    Columns with incompatible types across tables (e.g. string and double) are cast to string.
     """
-    Concat Dataframe with overlapping patients/variables.
+    try:
+        return pa.concat_tables(tables, promote_options='permissive')
+    except (pa.ArrowTypeError,pa.ArrowInvalid):
+        pass
+    types = {}
+    for table in tables:
+        for field in table.schema:
+            types.setdefault(field.name,[]).append(field.type)
+    conflicting = set()
+    for name,column_types in types.items():
+        try:
+            pa.unify_schemas([pa.schema([pa.field(name,t)]) for t in column_types],promote_options='permissive')
+        except (pa.ArrowTypeError,pa.ArrowInvalid):
+            conflicting.add(name)
+    cast_tables = []
+    for table in tables:
+        for name in conflicting.intersection(table.column_names):
+            i = table.schema.get_field_index(name)
+            table = table.set_column(i,name,table.column(i).cast(pa.string()))
+        cast_tables.append(table)
+    return pa.concat_tables(cast_tables, promote_options='permissive')
+
+def first_per_patient(table:pa.Table, patient_col="Patient")->pa.Table:
+    """
+    One row per patient, with the first non-nan value of each column if it exists.
+    Rows of patients that appear only once are kept as is (single hash count pass),
+    only duplicated patients go through the group_by. Row order is not preserved.
+    Rows without patient are dropped, as with pandas groupby.
+    The result is a single chunk, so that repeated calls (see fold_tables) do not accumulate chunks.
+    """
+    if table[patient_col].null_count>0:
+        table = table.filter(pc.is_valid(table[patient_col]))
+    counts = pc.value_counts(table[patient_col])
+    duplicated = pc.filter(counts.field('values'),pc.greater(counts.field('counts'),1))
+    if len(duplicated)==0:
+        return table.combine_chunks()
+    is_duplicated = pc.is_in(table[patient_col],value_set=duplicated)
+    return pa.concat_tables([
+        table.filter(pc.invert(is_duplicated)),
+        group_first(table.filter(is_duplicated),patient_col),
+        ]).combine_chunks()
+
+def group_first(table:pa.Table, patient_col="Patient")->pa.Table:
+    """
+    Group by patient, and pick the first non-nan value of each column if it exists.
+    Patients keep their order of first appearance.
+    """
+    #"first" has no kernel for dictionary columns: aggregate their indices against a unified dictionary
+    table = table.unify_dictionaries()
+    dictionaries = {}
+    for i,field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type) and field.name!=patient_col:
+            column = table.column(i)
+            dictionaries[field.name] = column.chunk(0).dictionary if column.num_chunks else pa.array([],field.type.value_type)
+            indices = pa.chunked_array([chunk.indices for chunk in column.chunks],field.type.index_type)
+            table = table.set_column(i,field.name,indices)
+
+    #all-empty columns are read with the null type, which has no "first" kernel either: added back afterwards
+    null_cols = [field.name for field in table.schema if pa.types.is_null(field.type) and field.name!=patient_col]
+
+    #no threads so that "first" follows the order of the rows
+    agg_specs=[(c,'first') for c in table.column_names if c!=patient_col and c not in null_cols]
+    merged = table.group_by(patient_col,use_threads=False).aggregate(agg_specs)
+    merged = merged.rename_columns([patient_col if c==patient_col else c[:-len('_first')] for c in merged.column_names])
+    for name in null_cols:
+        merged = merged.append_column(name,pa.nulls(merged.num_rows))
+    for name,dictionary in dictionaries.items():
+        i = merged.schema.get_field_index(name)
+        merged = merged.set_column(i,name,pa.DictionaryArray.from_arrays(merged.column(i).combine_chunks(),dictionary))
+    return merged.select(table.column_names)
+
+def merge_patient_dataframes(tables:list[pa.Table|pd.DataFrame], patient_col="Patient")->pa.Table:
+    """
+    Concat tables with overlapping patients/variables.
     For each patient, use the first non-nan value if it exists.
+    Patients are sorted, as with pandas groupby.
+    DataFrames are accepted too, and are stacked as Arrow tables rather than with pd.concat.
     """
+    #zero-copy for Arrow-backed columns, mixed-type object columns are cast to string
+    tables = [table_from_pandas(t) if isinstance(t,pd.DataFrame) else t for t in tables]
+
+    #Vertical stacking, columns missing from a table are filled with nulls
+    combined = stack_tables(tables)
+    return first_per_patient(combined,patient_col).sort_by(patient_col)
+
 
-    #Vertical stacking
-    combined = pd.concat(dfs, axis=0, ignore_index=True)
-    #groubby patient+pick first on-nan if exists
-    merged = combined.groupby(patient_col, as_index=False).first()
+#minimum number of stacked rows before a fold step reduces them into the merged table
+FOLD_MIN_ROWS=1_000_000
+
+def fold_batch(merged:pa.Table|None, batch:list[pa.Table], patient_col="Patient")->pa.Table:
+    """Reduce a batch of tables into the merged table, first non-nan value per patient"""
+    if merged is not None:
+        #patients already merged come first, so their values take precedence
+        batch = [merged]+batch
+    return first_per_patient(stack_tables(batch),patient_col)
+
+def fold_tables(tables, patient_col="Patient")->pa.Table|None:
+    """
+    Merge an iterable of tables without holding all of them in memory (same result as merge_patient_dataframes, unsorted).
+    Tables are stacked in batches, reduced once a batch holds as many rows as the merged table (and at least FOLD_MIN_ROWS),
+    so each row goes through a bounded number of reductions on average.
+    Returns None if there is no table.
+    """
+    merged = None
+    batch = []
+    batch_rows = 0
+    for table in tables:
+        batch.append(table)
+        batch_rows += table.num_rows
+        if batch_rows >= max(FOLD_MIN_ROWS, merged.num_rows if merged is not None else 0):
+            merged = fold_batch(merged,batch,patient_col)
+            batch = []
+            batch_rows = 0
+    if batch:
+        merged = fold_batch(merged,batch,patient_col)
     return merged
 
+#below this total input size, the single process fold is faster than spilling partitions
+PARALLEL_MIN_BYTES=256<<20
+
+def patient_partitions(table:pa.Table, patient_col:str, n_partitions:int)->list[pa.Table]:
+    """
+    Split a table in n_partitions by a hash of the patient: a patient lands in the same partition whatever the file.
+    Row order is kept within each partition, rows without patient are dropped.
+    """
+    if table[patient_col].null_count>0:
+        table = table.filter(pc.is_valid(table[patient_col]))
+    #hash of the string form whatever the type, so that 1, 1.0 and "1" from different files land together,
+    #as stack_tables casts conflicting columns to string
+    keys = table[patient_col].cast(pa.string()).to_numpy(zero_copy_only=False)
+    partition = pd.util.hash_array(keys) % n_partitions
+    return [table.filter(pa.array(partition==k)) for k in range(n_partitions)]
+
+def merge_partition(partition_dir:str, patient_col="Patient")->str|None:
+    """
+    Fold the spilled files of one partition, in input order, and write the result next to them.
+    Runs in a worker process, which only holds this partition in memory.
+    Returns the path of the result, None if the partition has no file.
+    """
+    names = sorted(os.listdir(partition_dir))
+    tables = (pyarrow.feather.read_table(os.path.join(partition_dir,name)) for name in names)
+    merged = fold_tables(tables,patient_col)
+    if merged is None:
+        return None
+    result_path = os.path.join(partition_dir,'merged.feather')
+    pyarrow.feather.write_feather(merged,result_path)
+    return result_path
+
+def spill_partitions(buffers:list[list[pa.Table]], partition_dirs:list[str], n_spills:int):
+    """
+    Write each buffer of partition tables as a single feather file in its partition directory, and empty the buffers.
+    Empty partitions are written too, so that every partition sees the columns in the same order.
+    """
+    for buffer,partition_dir in zip(buffers,partition_dirs):
+        pyarrow.feather.write_feather(stack_tables(buffer),os.path.join(partition_dir,f'{n_spills:08d}.feather'))
+        buffer.clear()
 
-def merge_files(file_paths, output_path, patient_col="Patient",add_filenamecolumn=True,filename_column='TABLENAME',**reader_kwargs)->pd.DataFrame:
+def merge_files_partitioned(file_paths, patient_col="Patient", processes=2, add_filenamecolumn=True,filename_column='TABLENAME',cache_dir=None,max_workers=None,**reader_kwargs)->pa.Table|None:
+    """
+    Merge inputs larger than memory: each file is split by patient hash (see patient_partitions) as it is read,
+    and the partitions are spilled as feather files in a temporary directory (TMPDIR).
+    Each partition is then folded in its own process, so memory per process is bounded by the size of its partition.
+    Patients are not sorted. Returns None if no file could be read.
+    """
+    with tempfile.TemporaryDirectory() as spill_dir:
+        partition_dirs = [os.path.join(spill_dir,str(k)) for k in range(processes)]
+        for partition_dir in partition_dirs:
+            os.mkdir(partition_dir)
+        #partitions of consecutive files are buffered and spilled together, one file per partition every FOLD_MIN_ROWS rows
+        buffers = [[] for _ in partition_dirs]
+        buffered_rows = 0
+        n_spills = 0
+        for table in iter_files(file_paths,add_filenamecolumn,filename_column,cache_dir,max_workers,**reader_kwargs):
+            for buffer,partition in zip(buffers,patient_partitions(table,patient_col,processes)):
+                buffer.append(partition)
+            buffered_rows += table.num_rows
+            del table
+            if buffered_rows>=FOLD_MIN_ROWS:
+                spill_partitions(buffers,partition_dirs,n_spills)
+                buffered_rows = 0
+                n_spills += 1
+        if buffers[0]:
+            spill_partitions(buffers,partition_dirs,n_spills)
+        #spawn rather than fork: the parent has Arrow thread pools running
+        with ProcessPoolExecutor(max_workers=processes,mp_context=multiprocessing.get_context('spawn')) as executor:
+            result_paths = [path for path in executor.map(partial(merge_partition,patient_col=patient_col),partition_dirs) if path is not None]
+        if not result_paths:
+            return None
+        #each patient is in a single partition, so the partition results are simply stacked
+        return stack_tables([pyarrow.feather.read_table(path) for path in result_paths])
+
+def merge_files(file_paths, output_path, patient_col="Patient",add_filenamecolumn=True,filename_column='TABLENAME',cache_dir=None,max_workers=None,processes=1,**reader_kwargs)->pd.DataFrame:
     """
     Read, merge, save
+    Files are folded in batches into the merged table (see fold_tables), so only the merged
+    table, the current batch and the files being read ahead are held in memory
+    With processes>1 and at least PARALLEL_MIN_BYTES of input, patients are partitioned across processes (see merge_files_partitioned)
+    reader_kwargs are passed to the reader of every file (see load_files): Arrow options for csv and tsv,
+    pandas options (sep, encoding, dtype...) raise a TypeError
     """
-    dfs = load_files(file_paths,add_filenamecolumn,filename_column,**reader_kwargs)
-    merged_df = merge_patient_dataframes(dfs, patient_col=patient_col)
-    write_table(merged_df,output_path,index=False)
-    return merged_df
+    if processes>1 and sum(os.path.getsize(path) for path in file_paths)>=PARALLEL_MIN_BYTES:
+        merged = merge_files_partitioned(file_paths,patient_col,processes,add_filenamecolumn,filename_column,cache_dir,max_workers,**reader_kwargs)
+    else:
+        merged = fold_tables(iter_files(file_paths,add_filenamecolumn,filename_column,cache_dir,max_workers,**reader_kwargs),patient_col)
+    if merged is None:
+        raise ValueError('None of the input files could be read')
+    merged = merged.sort_by(patient_col)
+    write_table(merged,output_path)
+    return merged.to_pandas(types_mapper=pd.ArrowDtype)
+
+#dash->space and umlauts, applied in a single str.translate pass
+STR_TRANSLATIONS=str.maketrans({'-':' ','ä':'ae','ö':'oe','ü':'ue'})
+MULTIPLE_SPACES=re.compile(r"\s+")
 
 def normalize_str_series(s:pd.Series)->pd.Series:
+    if pd.api.types.is_string_dtype(s.dtype) and s.dtype!=object:
+        return normalize_arrow_str_series(s)
     return (
         s.astype(str)
         .str.casefold() #lower case and ß->ss
-        .str.replace('-',' ',regex=False)#umlaut
-        .str.replace("ä", "ae", regex=False)
-        .str.replace("ö", "oe", regex=False)
-        .str.replace("ü", "ue", regex=False)
-        .str.replace("-", " ", regex=False)
-        .str.replace(r"\s+"," ",regex=True)#multiple spaces
+        .str.translate(STR_TRANSLATIONS)
+        .str.replace(MULTIPLE_SPACES," ",regex=True)#multiple spaces
         .str.strip()#start and end of line
     )
 
+def normalize_arrow_str_series(s:pd.Series)->pd.Series:
+    '''Same as normalize_str_series for Arrow-backed strings, with Arrow compute kernels instead of python str'''
+    arr=pc.utf8_lower(pa.array(s.array))
+    for pattern,replacement in (("ß","ss"),("-"," "),("ä","ae"),("ö","oe"),("ü","ue")):
+        arr=pc.replace_substring(arr,pattern,replacement)
+    arr=pc.replace_substring_regex(arr,r"\s+"," ")#multiple spaces
+    arr=pc.utf8_trim_whitespace(arr)#start and end of line
+    return pd.Series(arr,index=s.index,dtype=pd.ArrowDtype(arr.type),name=s.name)
+
 
 
+@lru_cache(maxsize=None)
+def equal_or_nan_kernel():
+    '''
+    numba kernel for the float64 compare, imported and compiled on first use so that merging never pays for the JIT.
+    Returns None if numba is not installed (numpy is used instead).
+    '''
+    try:
+        from numba import njit, prange
+    except ImportError:
+        return None
+
+    @njit(parallel=True,cache=True)
+    def equal_or_nan(a,b,out):
+        '''Single pass over two float64 (rows x cols) arrays, one thread per column'''
+        for j in prange(a.shape[1]):
+            for i in range(a.shape[0]):
+                x=a[i,j]
+                y=b[i,j]
+                out[i,j]=(x==y) or (x!=x) or (y!=y)
+    return equal_or_nan
+
+def compare_columns(joint:pd.DataFrame,cols:list[str],dtype=object,normalize:bool=False)->np.ndarray:
+    '''
+    Compare the _df1 and _df2 versions of cols in a single block.
+    Returns a (rows x cols) boolean array, True where values are equal or at least one is nan
+    '''
+    s1=joint[[col+'_df1' for col in cols]]
+    s2=joint[[col+'_df2' for col in cols]]
+    if dtype=='category':
+        #same categories on both sides: compare the integer codes, -1 is nan
+        a=s1.apply(lambda s:s.cat.codes).to_numpy()
+        b=s2.apply(lambda s:s.cat.codes).to_numpy()
+        return (a==b) | (a<0) | (b<0)
+    equal_or_nan=equal_or_nan_kernel() if dtype==np.float64 else None
+    if equal_or_nan is not None:
+        #column-major so that each thread scans contiguous memory
+        a=np.asfortranarray(s1.to_numpy(dtype=np.float64,na_value=np.nan))
+        b=np.asfortranarray(s2.to_numpy(dtype=np.float64,na_value=np.nan))
+        out=np.empty(a.shape,dtype=np.bool_,order='F')
+        equal_or_nan(a,b,out)
+        return out
+    missing=s1.isna().to_numpy(dtype=bool) | s2.isna().to_numpy(dtype=bool)
+    if normalize:
+        s1=s1.apply(normalize_str_series)
+        s2=s2.apply(normalize_str_series)
+    if dtype==np.int64:
+        #through nullable Int64: bool and missing values have no direct int64 conversion
+        s1=s1.astype('Int64')
+        s2=s2.astype('Int64')
+    na_value=np.nan if dtype==np.float64 else 0 if dtype==np.int64 else None
+    a=s1.to_numpy(dtype=dtype,na_value=na_value)
+    b=s2.to_numpy(dtype=dtype,na_value=na_value)
+    return (a==b) | missing
+
+def is_uint64(dtype)->bool:
+    return pd.api.types.is_unsigned_integer_dtype(dtype) and dtype.itemsize==8
+
+def fits_int64(dtype)->bool:
+    '''bool and integer dtypes, compared exactly as int64'''
+    return pd.api.types.is_bool_dtype(dtype) or (pd.api.types.is_integer_dtype(dtype) and not is_uint64(dtype))
+
 def sanity_check_dataframes(df1:pd.DataFrame,df2:pd.DataFrame,joint_keys:list[str])->bool:
     '''Check if all values of overlapping columns between df1 and df2 are equal'''
     #common columns outside joint keys
@@ -106,39 +598,46 @@ def sanity_check_dataframes(df1:pd.DataFrame,df2:pd.DataFrame,joint_keys:list[st
     if joint.empty:
         return False #nothing common
 
-    comparisons=[]
-    for col in col_intersec:
-        s1=joint[col+'_df1']
-        s2=joint[col+'_df2']
-
-        # numeric case
-        if pd.api.types.is_numeric_dtype(s1) and pd.api.types.is_numeric_dtype(s2):
-            #check if when both are non nan value is equal
-            equal= (s1==s2) | s1.isna() | s2.isna()
-        #str case : first we need to normalize the str
-        elif s1.dtype=='str':
-            equal=(normalize_str_series(s1)==normalize_str_series(s2)) | s1.isna() | s2.isna()
-        else:
-            equal = (s1 == s2) | s1.isna() | s2.isna()
-        comparisons.append(equal)
-        conflict=~equal
-        if conflict.any():
-            has_conflict = True
-
+    #integer and bool case: compared exactly, float64 would merge integers above 2**53
+    integer_cols=[col for col in col_intersec if fits_int64(joint[col+'_df1'].dtype) and fits_int64(joint[col+'_df2'].dtype)]
+    # numeric case (uint64 does not fit in float64 either, it goes with the other columns)
+    numeric_cols=[col for col in col_intersec
+                  if col not in integer_cols and pd.api.types.is_numeric_dtype(joint[col+'_df1']) and pd.api.types.is_numeric_dtype(joint[col+'_df2'])
+                  and not is_uint64(joint[col+'_df1'].dtype) and not is_uint64(joint[col+'_df2'].dtype)]
+    #categorical case with identical categories in the same order (so same codes): no need to look at the values
+    #CategoricalDtype equality ignores the order of unordered categories, compare the categories themselves
+    categorical_cols=[col for col in col_intersec
+                      if isinstance(joint[col+'_df1'].dtype,pd.CategoricalDtype) and isinstance(joint[col+'_df2'].dtype,pd.CategoricalDtype)
+                      and joint[col+'_df1'].cat.categories.equals(joint[col+'_df2'].cat.categories)]
+    #str case : first we need to normalize the str
+    str_cols=[col for col in col_intersec if col not in integer_cols and col not in numeric_cols and pd.api.types.is_string_dtype(joint[col+'_df1'].dtype) and joint[col+'_df1'].dtype!=object]
+    other_cols=[col for col in col_intersec if col not in integer_cols and col not in numeric_cols and col not in categorical_cols and col not in str_cols]
+
+    #one vectorized compare per dtype block instead of one per column
+    #cheapest blocks first, stop at the first conflicting block
+    blocks=((integer_cols,np.int64,False),(numeric_cols,np.float64,False),(categorical_cols,'category',False),(other_cols,object,False),(str_cols,object,True))
+    for cols,dtype,normalize in blocks:
+        if not cols:
+            continue
+        equal=compare_columns(joint,cols,dtype,normalize)
+        conflict_cols=np.flatnonzero(~equal.all(axis=0))
+        if len(conflict_cols)>0:
+            col=cols[conflict_cols[0]]
+            conflict=~equal[:,conflict_cols[0]]
             print(f"\nConflict detected in column: {col}")
             print(
                 joint.loc[conflict, joint_keys + 
                           [f"{col}_df1", f"{col}_df2"]]
             )
-            raise ValueError('Debug')
+            return False
 
-    return pd.concat(comparisons,axis=1).all().all()
+    return True
 
 def parse_conflicts(df1:pd.DataFrame,df2:pd.DataFrame,joint_keys:list[str])->bool:
     '''Check if all values of overlapping columns between df1 and df2 are equal
     When conflict detected, parse to decide manually whether to ignore the conflict
 
-    returns False if no conflict is detected, or if the user validates the consistency of the dataframes
+    returns True if no conflict is detected, or if the user validates the consistency of the dataframes
     '''
     if df1.empty or df2.empty: 
         print('Empty dataframe')
@@ -152,7 +651,6 @@ def parse_conflicts(df1:pd.DataFrame,df2:pd.DataFrame,joint_keys:list[str])->boo
     if joint.empty:
         return False #nothing common
 
-    comparisons=[]
     for col in col_intersec:
         s1=joint[col+'_df1']
         s2=joint[col+'_df2']
@@ -162,30 +660,27 @@ def parse_conflicts(df1:pd.DataFrame,df2:pd.DataFrame,joint_keys:list[str])->boo
         conflict = (~s1.isna()) & (~s2.isna()) & (s1 != s2)
 
         if conflict.any():
-            has_conflict = True
-
             print(f"\nConflict detected in column: {col}")
             print(
                 joint.loc[conflict, joint_keys + 
                           [f"{col}_df1", f"{col}_df2"]]
             )
             proceed=input('Is conflict OK or not Y/N')
-            if proceed.lower()=='y': 
-                conflict[:]=False
-            else:
-                conflict[:]==True
-        comparisons.append(conflict)
+            if proceed.lower()!='y': 
+                return False #no need to check the remaining columns
 
-    return pd.concat(comparisons,axis=1).all().all()
+    return True
 
 def main():
     parser=argparse.ArgumentParser(
-        description="Merge multiple tabular datasets into a csv file"
+        description="Merge multiple tabular datasets into a csv, parquet or xlsx file"
     )
     parser.add_argument("-i",'--inputs', nargs='+',help='Input files to merge')
     parser.add_argument("-d", "--directory",help="Directory containing input files")
-    parser.add_argument('-o','--output',required=True,help='Output file')
+    parser.add_argument('-o','--output',required=True,help='Output file (.csv, .parquet or .xlsx)')
     parser.add_argument('--joint-col',default='Patient',help='Name of the column to joint the files (default: Patient)')
+    parser.add_argument('--cache-dir',default=None,help='Directory where parsed input files are cached as feather files (default: no cache)')
+    parser.add_argument('-p','--processes',type=int,default=1,help='Number of processes to merge large inputs, partitioned by joint column and spilled to TMPDIR (default: 1)')
     parser.add_argument('-v','--verbose',action="store_true",help='Whether to display the extracted files')
     args=parser.parse_args() 
 
@@ -198,7 +693,7 @@ def main():
     
     if args.verbose: 
         print('Extracted {} files: \n {}'.format(len(inputs),str(inputs)))
-    merge_files(inputs,args.output,args.joint_col)
+    merge_files(inputs,args.output,args.joint_col,cache_dir=args.cache_dir,processes=args.processes)
     return
 
 if __name__=='__main__':